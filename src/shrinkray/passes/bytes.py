@@ -362,10 +362,10 @@ class ByteReplacement(Patches[ReplacementPatch, bytes]):
         return result
 
     def apply(self, patch: ReplacementPatch, target: bytes) -> bytes:
-        result = bytearray()
-        for c in target:
-            result.append(patch.get(c, c))
-        return bytes(result)
+        table = bytearray(range(256))
+        for k, v in patch.items():
+            table[k] = v
+        return target.translate(table)
 
     def size(self, patch: ReplacementPatch) -> int:
         return 0
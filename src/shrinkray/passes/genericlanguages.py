@@ -2,9 +2,12 @@
 Module of reduction passes designed for "things that look like programming languages".
 """
 
+import operator
 import re
+from array import array
+from bisect import bisect_left
 from functools import wraps
-from string import ascii_lowercase, ascii_uppercase
+from string import ascii_lowercase, ascii_uppercase, digits
 from typing import AnyStr, Callable
 
 import trio
@@ -19,7 +22,6 @@ from shrinkray.problem import (
     ParseError,
     ReductionProblem,
 )
-from shrinkray.work import NotFound
 
 
 @define(frozen=True)
@@ -38,7 +40,125 @@ class Substring(Format[AnyStr, AnyStr]):
             raise ParseError()
 
     def dumps(self, input: AnyStr) -> AnyStr:
-        return self.prefix + input + self.suffix
+        # A single join avoids allocating an intermediate for prefix + input.
+        return input[:0].join((self.prefix, input, self.suffix))
+
+
+def splice(target: AnyStr, start: int, end: int, replacement: AnyStr) -> AnyStr:
+    """Returns `target` with `target[start:end]` replaced by `replacement`."""
+    if isinstance(target, bytes):
+        # Slicing a memoryview doesn't copy, so this way the only copy of
+        # target that gets made is the one into the result.
+        view = memoryview(target)
+        return b"".join((view[:start], replacement, view[end:]))
+    return target[:0].join((target[:start], replacement, target[end:]))
+
+
+async def reduce_matching_regions(
+    problem: ReductionProblem[AnyStr],
+    pattern: re.Pattern[AnyStr],
+    choose_pass: Callable[[re.Match[AnyStr]], ReductionPass[AnyStr]],
+) -> None:
+    """Finds every non-overlapping match of `pattern` in the current test case
+    and concurrently reduces each one as a separate problem, using the pass
+    `choose_pass` returns for its match."""
+    initial = problem.current_test_case
+
+    # We keep track of the test case with all accepted replacements
+    # applied, along with where each region currently starts in it and
+    # how long it currently is, so that trying a replacement is a single
+    # splice rather than a rebuild of the whole test case from every
+    # region. The current value of each region is just a slice of this, so
+    # there's no need to store them separately. version is bumped every time
+    # this changes, so that we can cheaply tell whether another region has
+    # been updated in the meantime.
+    current = initial
+    starts = array("Q")
+    lengths = array("Q")
+    region_passes = []
+    for m in pattern.finditer(initial):
+        u, v = m.span()
+        starts.append(u)
+        lengths.append(v - u)
+        region_passes.append(choose_pass(m))
+    version = 0
+
+    if not starts:
+        return
+
+    def replace(i: int, s: AnyStr) -> AnyStr:
+        start = starts[i]
+        return splice(current, start, start + lengths[i], s)
+
+    def set_replacement(i: int, s: AnyStr) -> None:
+        nonlocal current, version
+        version += 1
+        delta = len(s) - lengths[i]
+        current = replace(i, s)
+        lengths[i] = len(s)
+        if delta != 0:
+            for j in range(i + 1, len(starts)):
+                starts[j] += delta
+
+    async with trio.open_nursery() as nursery:
+        current_merge_attempts = 0
+        # Set whenever current_merge_attempts is zero, so that tasks can wait
+        # for merging to finish without polling.
+        merge_idle = trio.Event()
+        merge_idle.set()
+
+        async def reduce_region(i: int) -> None:
+            async def is_interesting(s: AnyStr) -> bool:
+                nonlocal current_merge_attempts, merge_idle
+                is_merging = False
+                retries = 0
+                try:
+                    while True:
+                        # Other tasks may have updated the test case, so when we
+                        # check whether something is interesting but it doesn't update
+                        # the test case, this means something has changed. Given that
+                        # we found a promising reduction, it's likely to be worth trying
+                        # again. In theory an uninteresting test case could also become
+                        # interesting if the underlying test case changes, but that's
+                        # not likely enough to be worth checking.
+                        while not is_merging and current_merge_attempts > 0:
+                            await merge_idle.wait()
+
+                        attempt_version = version
+                        attempt = replace(i, s)
+                        if not await problem.is_interesting(attempt):
+                            return False
+                        if version == attempt_version:
+                            set_replacement(i, s)
+                            return True
+                        if not is_merging:
+                            is_merging = True
+                            if current_merge_attempts == 0:
+                                merge_idle = trio.Event()
+                            current_merge_attempts += 1
+
+                        retries += 1
+
+                        # If we've retried this many times then something has gone seriously
+                        # wrong with our concurrency approach and it's probably a bug.
+                        assert retries <= 100
+                finally:
+                    if is_merging:
+                        current_merge_attempts -= 1
+                        assert current_merge_attempts >= 0
+                        if current_merge_attempts == 0:
+                            merge_idle.set()
+
+            start = starts[i]
+            subproblem = BasicReductionProblem(
+                current[start : start + lengths[i]],
+                is_interesting,
+                work=problem.work,
+            )
+            nursery.start_soon(region_passes[i], subproblem)
+
+        for i in range(len(starts)):
+            await reduce_region(i)
 
 
 def regex_pass(
@@ -51,97 +171,63 @@ def regex_pass(
     def inner(fn: ReductionPass[AnyStr]) -> ReductionPass[AnyStr]:
         @wraps(fn)
         async def reduction_pass(problem: ReductionProblem[AnyStr]) -> None:
-            matching_regions = []
+            await reduce_matching_regions(problem, pattern, lambda m: fn)
 
-            i = 0
-            while i < len(problem.current_test_case):
-                search = pattern.search(problem.current_test_case, i)
-                if search is None:
-                    break
+        # Recorded so that fused_regex_pass can scan for this pass's regions
+        # along with other passes' and run fn (available as __wrapped__) on
+        # them directly.
+        reduction_pass.pattern = pattern  # type: ignore[attr-defined]
+        return reduction_pass
 
-                u, v = search.span()
-                matching_regions.append((u, v))
+    return inner
 
-                i = v
 
-            if not matching_regions:
-                return
+INLINE_FLAGS = [
+    (re.IGNORECASE, "i"),
+    (re.MULTILINE, "m"),
+    (re.DOTALL, "s"),
+    (re.VERBOSE, "x"),
+]
+
+
+def fused_regex_pass(*passes: ReductionPass[AnyStr]) -> ReductionPass[AnyStr]:
+    """Combines several passes defined with regex_pass into a single pass
+    that finds all of their regions in one scan, and reduces each region with
+    the pass whose pattern matched it.
+
+    The passes only see the regions they would have found on their own if
+    their patterns can never match overlapping parts of the test case, so
+    only fuse passes for which that is true. Their patterns also have to
+    refer back to their own groups by name rather than by number, as the
+    numbers change when the patterns are put together."""
+    alternatives = []
+    region_passes: dict[str, ReductionPass[AnyStr]] = {}
+    for rp in passes:
+        pattern: re.Pattern[AnyStr] = rp.pattern  # type: ignore[attr-defined]
+        inline_flags = "".join(c for flag, c in INLINE_FLAGS if pattern.flags & flag)
+        prefix = f"(?P<{rp.__name__}>(?{inline_flags}:"
+        if alternatives:
+            prefix = "|" + prefix
+        suffix = "))"
+        if isinstance(pattern.pattern, bytes):
+            alternatives.append(
+                prefix.encode("ascii") + pattern.pattern + suffix.encode("ascii")
+            )
+        else:
+            alternatives.append(prefix + pattern.pattern + suffix)
+        region_passes[rp.__name__] = rp.__wrapped__  # type: ignore[attr-defined]
+    fused = re.compile(alternatives[0][:0].join(alternatives))
 
-            initial = problem.current_test_case
-
-            replacements = [initial[u:v] for u, v in matching_regions]
-
-            def replace(i: int, s: AnyStr) -> AnyStr:
-                empty = initial[:0]
-
-                parts = []
-
-                prev = 0
-                for j, (u, v) in enumerate(matching_regions):
-                    parts.append(initial[prev:u])
-                    if j != i:
-                        parts.append(replacements[j])
-                    else:
-                        parts.append(s)
-                    prev = v
-
-                parts.append(initial[prev:])
-
-                return empty.join(parts)
-
-            async with trio.open_nursery() as nursery:
-                current_merge_attempts = 0
-
-                async def reduce_region(i: int) -> None:
-                    async def is_interesting(s: AnyStr) -> bool:
-                        nonlocal current_merge_attempts
-                        is_merging = False
-                        retries = 0
-                        try:
-                            while True:
-                                # Other tasks may have updated the test case, so when we
-                                # check whether something is interesting but it doesn't update
-                                # the test case, this means something has changed. Given that
-                                # we found a promising reduction, it's likely to be worth trying
-                                # again. In theory an uninteresting test case could also become
-                                # interesting if the underlying test case changes, but that's
-                                # not likely enough to be worth checking.
-                                while not is_merging and current_merge_attempts > 0:
-                                    await trio.sleep(0.01)
-
-                                attempt = replace(i, s)
-                                if not await problem.is_interesting(attempt):
-                                    return False
-                                if replace(i, s) == attempt:
-                                    replacements[i] = s
-                                    return True
-                                if not is_merging:
-                                    is_merging = True
-                                    current_merge_attempts += 1
-
-                                retries += 1
-
-                                # If we've retried this many times then something has gone seriously
-                                # wrong with our concurrency approach and it's probably a bug.
-                                assert retries <= 100
-                        finally:
-                            if is_merging:
-                                current_merge_attempts -= 1
-                                assert current_merge_attempts >= 0
-
-                    subproblem = BasicReductionProblem(
-                        replacements[i],
-                        is_interesting,
-                        work=problem.work,
-                    )
-                    nursery.start_soon(fn, subproblem)
-
-                for i in range(len(matching_regions)):
-                    await reduce_region(i)
+    def choose_pass(m: re.Match[AnyStr]) -> ReductionPass[AnyStr]:
+        assert m.lastgroup is not None
+        return region_passes[m.lastgroup]
 
-        return reduction_pass
+    async def reduction_pass(problem: ReductionProblem[AnyStr]) -> None:
+        await reduce_matching_regions(problem, fused, choose_pass)
 
-    return inner
+    reduction_pass.__name__ = "+".join(region_passes)
+
+    return reduction_pass
 
 
 async def reduce_integer(problem: ReductionProblem[int]) -> None:
@@ -150,24 +236,36 @@ async def reduce_integer(problem: ReductionProblem[int]) -> None:
     if await problem.is_interesting(0):
         return
 
+    # Invariant: lo is not interesting and hi is.
     lo = 0
     hi = problem.current_test_case
 
-    while lo + 1 < hi:
-        mid = (lo + hi) // 2
+    # The smallest interesting value is often much smaller than the current
+    # one, so we first probe upwards exponentially. This finds a small answer
+    # in O(log(answer)) calls rather than the O(log(hi)) of bisecting from
+    # the start, at the cost of roughly doubling the calls when the answer
+    # is close to hi.
+    probe = 1
+    while probe < hi:
+        if await problem.is_interesting(probe):
+            hi = probe
+            break
+        lo = probe
+        probe *= 2
+
+    # Each iteration makes exactly one call to the interestingness test and
+    # at least halves the gap between lo and hi, so we need at most
+    # hi.bit_length() iterations to close it.
+    for _ in range(hi.bit_length()):
+        half = (hi - lo) // 2
+        if half == 0:
+            break
+        mid = lo + half
         if await problem.is_interesting(mid):
             hi = mid
         else:
             lo = mid
 
-        if await problem.is_interesting(hi - 1):
-            hi -= 1
-
-        if await problem.is_interesting(lo + 1):
-            return
-        else:
-            lo += 1
-
 
 class IntegerFormat(Format[bytes, int]):
     def parse(self, input: bytes) -> int:
@@ -185,20 +283,25 @@ async def reduce_integer_literals(problem: ReductionProblem[bytes]) -> None:
     await reduce_integer(problem.view(IntegerFormat()))
 
 
-@regex_pass(rb"[0-9]+ [*+-/] [0-9]+")
+ARITHMETIC_OPERATORS: dict[bytes, Callable[[int, int], int | float]] = {
+    b"+": operator.add,
+    b"-": operator.sub,
+    b"*": operator.mul,
+    b"/": operator.truediv,
+}
+
+
+@regex_pass(rb"[0-9]+ [*+\-/] [0-9]+")
 async def combine_expressions(problem: ReductionProblem[bytes]) -> None:
+    left, op, right = problem.current_test_case.split()
     try:
-        # NB: Use of eval is safe, as everything passed to this is a simple
-        # arithmetic expression. Would ideally replace with a guaranteed
-        # safe version though.
-        await problem.is_interesting(
-            str(eval(problem.current_test_case)).encode("ascii")
-        )
+        result = ARITHMETIC_OPERATORS[op](int(left), int(right))
     except ArithmeticError:
-        pass
+        return
+    await problem.is_interesting(str(result).encode("ascii"))
 
 
-@regex_pass(rb'([\'"])\s*\1')
+@regex_pass(rb"(?P<quote>['\"])\s*(?P=quote)")
 async def merge_adjacent_strings(problem: ReductionProblem[bytes]) -> None:
     await problem.is_interesting(b"")
 
@@ -208,6 +311,18 @@ async def replace_falsey_with_zero(problem: ReductionProblem[bytes]) -> None:
     await problem.is_interesting(b"0")
 
 
+# Integers and expressions overlap, as do empty strings and falsey values,
+# so we can only fuse these passes in pairs that never match the same part
+# of a test case.
+reduce_integers_and_falsey = fused_regex_pass(
+    reduce_integer_literals, replace_falsey_with_zero
+)
+
+combine_expressions_and_strings = fused_regex_pass(
+    combine_expressions, merge_adjacent_strings
+)
+
+
 async def simplify_brackets(problem: ReductionProblem[bytes]) -> None:
     bracket_types = [b"[]", b"{}", b"()"]
 
@@ -223,8 +338,35 @@ def shortlex(s):
     return (len(s), s)
 
 
+WORD_CHARACTERS = frozenset(
+    (ascii_lowercase + ascii_uppercase + digits + "_").encode("ascii")
+)
+
+
+def identifier_occurrences(source: bytes) -> dict[bytes, list[tuple[int, int]]]:
+    """Maps each identifier in `source` to the spans where it appears as a
+    whole word, finding all of them in a single pass over `source`. Numbers
+    that only appear as part of some larger word are still included, with no
+    spans."""
+    result: dict[bytes, list[tuple[int, int]]] = {}
+    for m in IDENTIFIER.finditer(source):
+        u, v = m.span()
+        spans = result.setdefault(m.group(0), [])
+        # Numbers are matched without word boundaries (e.g. the 12 in 12abc),
+        # so we need to check those here.
+        if u > 0 and source[u - 1] in WORD_CHARACTERS:
+            continue
+        if v < len(source) and source[v] in WORD_CHARACTERS:
+            continue
+        spans.append((u, v))
+    return result
+
+
 async def normalize_identifiers(problem: ReductionProblem[bytes]) -> None:
-    identifiers = {m.group(0) for m in IDENTIFIER.finditer(problem.current_test_case)}
+    current = problem.current_test_case
+    occurrences = identifier_occurrences(current)
+
+    identifiers = set(occurrences)
     replacements = set(identifiers)
 
     for char_type in [ascii_lowercase, ascii_uppercase]:
@@ -235,23 +377,108 @@ async def normalize_identifiers(problem: ReductionProblem[bytes]) -> None:
                 break
 
     replacements = sorted(replacements, key=shortlex)
+    replacement_keys = [shortlex(r) for r in replacements]
     targets = sorted(identifiers, key=shortlex, reverse=True)
 
-    # TODO: This could use better parallelisation.
-    for t in targets:
-        pattern = re.compile(rb"\b" + t + rb"\b")
-        source = problem.current_test_case
-        if not pattern.search(source):
-            continue
-
-        async def can_replace(r):
-            if shortlex(r) >= shortlex(t):
-                return False
-            attempt = pattern.sub(r, source)
-            assert attempt != source
-            return await problem.is_interesting(attempt)
-
+    # We keep track of the test case with all of our accepted replacements
+    # applied ourselves, rather than building attempts on whatever
+    # problem.current_test_case is. An attempt built on an older test case is
+    # still accepted by the problem if it's smaller, which would undo another
+    # target's replacement, so we need to notice when that might have happened.
+    # version is bumped every time current changes so that we can cheaply tell.
+    version = 0
+    occurrences_version = version
+    split_cache: dict[bytes, list[bytes]] = {}
+
+    # Identifiers that we believe currently occur as whole words. Replacing a
+    # whole word with another identifier never changes where the word
+    # boundaries are, so we can keep this up to date ourselves and skip absent
+    # targets without rescanning the test case.
+    present = {t for t, spans in occurrences.items() if spans}
+
+    def split_around(t: bytes) -> list[bytes]:
+        """Returns the parts of the current test case either side of each
+        occurrence of `t`, so that replacing `t` with `r` is `r.join(...)` of
+        these. `t` must currently occur in the test case."""
+        # Only rescan when the test case has changed since we last looked,
+        # which is once per successful replacement rather than once per target.
+        nonlocal occurrences, occurrences_version
+        if occurrences_version != version:
+            occurrences = identifier_occurrences(current)
+            occurrences_version = version
+            split_cache.clear()
         try:
-            await problem.work.find_first_value(replacements, can_replace)
-        except NotFound:
+            return split_cache[t]
+        except KeyError:
             pass
+        spans = occurrences[t]
+        assert spans
+        parts = []
+        prev = 0
+        for u, v in spans:
+            parts.append(current[prev:u])
+            prev = v
+        parts.append(current[prev:])
+        split_cache[t] = parts
+        return parts
+
+    async def normalize_target(t: bytes) -> None:
+        if t not in present:
+            return
+
+        # Only replacements that sort strictly before t are worth trying,
+        # and as replacements is sorted those are exactly a prefix of it.
+        candidates = replacements[: bisect_left(replacement_keys, shortlex(t))]
+
+        async def can_replace(r: bytes) -> bool:
+            nonlocal current, version
+            retries = 0
+            while True:
+                attempt_version = version
+                # Only this target's own replacement removes t from the test
+                # case, so it's still there however many others have changed.
+                attempt = r.join(split_around(t))
+                if not await problem.is_interesting(attempt):
+                    return False
+                if version == attempt_version:
+                    current = attempt
+                    version += 1
+                    present.discard(t)
+                    present.add(r)
+                    return True
+
+                # Another target was replaced while we were checking this, so
+                # our attempt is missing that replacement and, if the problem
+                # accepted it, will have undone it. Trying again on top of the
+                # new test case puts both replacements in.
+                retries += 1
+
+                # If we've retried this many times then something has gone seriously
+                # wrong with our concurrency approach and it's probably a bug.
+                assert retries <= 100
+
+        # We try candidates one at a time even when running in parallel. If
+        # several were in flight at once and had to retry after another
+        # target changed the test case, whichever retry finished first would
+        # win rather than the smallest candidate, and the problem could accept
+        # an attempt for a candidate we then decided against.
+        for r in candidates:
+            if await can_replace(r):
+                return
+
+    if problem.work.parallelism == 1:
+        for t in targets:
+            await normalize_target(t)
+    else:
+        # Workers take targets from a shared iterator, so that targets still
+        # start in order (longest first), just several at a time.
+        remaining_targets = iter(targets)
+
+        async def worker() -> None:
+            for t in remaining_targets:
+                await normalize_target(t)
+
+        async with trio.open_nursery() as nursery:
+            for _ in range(problem.work.parallelism):
+                nursery.start_soon(worker)
+
@@ -28,11 +28,9 @@ from shrinkray.passes.bytes import (
 from shrinkray.passes.clangdelta import ClangDelta, clang_delta_pumps
 from shrinkray.passes.definitions import ReductionPass, ReductionPump
 from shrinkray.passes.genericlanguages import (
-    combine_expressions,
-    merge_adjacent_strings,
+    combine_expressions_and_strings,
     normalize_identifiers,
-    reduce_integer_literals,
-    replace_falsey_with_zero,
+    reduce_integers_and_falsey,
     simplify_brackets,
 )
 from shrinkray.passes.python import PYTHON_PASSES, is_python
@@ -154,10 +152,8 @@ class ShrinkRay(Reducer[bytes]):
             remove_indents,
             remove_whitespace,
             compose(Tokenize(), block_deletion(1, 20)),
-            reduce_integer_literals,
-            replace_falsey_with_zero,
-            combine_expressions,
-            merge_adjacent_strings,
+            reduce_integers_and_falsey,
+            combine_expressions_and_strings,
             lexeme_based_deletions,
             short_deletions,
             normalize_identifiers,
@@ -6,6 +6,7 @@ from hypothesis import assume, example, given, strategies as st
 
 from shrinkray.passes.bytes import (
     WHITESPACE,
+    ByteReplacement,
     debracket,
     find_ngram_endpoints,
     short_deletions,
@@ -142,3 +143,11 @@ def test_debracket():
         reduce_with([debracket], b"(1 + 2) + (3 + 4)", lambda x: b"(3 + 4)" in x)
         == b"1 + 2 + (3 + 4)"
     )
+
+
+@given(st.binary(), st.dictionaries(st.integers(0, 255), st.integers(0, 255)))
+def test_byte_replacement_replaces_each_byte(
+    target: bytes, patch: dict[int, int]
+) -> None:
+    result = ByteReplacement().apply(patch, target)
+    assert list(result) == [patch.get(c, c) for c in target]
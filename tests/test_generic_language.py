@@ -1,7 +1,25 @@
+import re
+from random import Random
+
+import pytest
+import trio
+
 from shrinkray.passes.genericlanguages import (
+    Substring,
     combine_expressions,
+    combine_expressions_and_strings,
+    fused_regex_pass,
+    identifier_occurrences,
+    normalize_identifiers,
+    reduce_integer,
     reduce_integer_literals,
+    reduce_integers_and_falsey,
+    regex_pass,
+    simplify_brackets,
+    splice,
 )
+from shrinkray.problem import BasicReductionProblem, ReductionProblem
+from shrinkray.work import WorkContext
 
 from tests.helpers import reduce_with
 
@@ -27,8 +45,262 @@ def test_does_not_error_on_bad_expression() -> None:
     assert reduce_with([combine_expressions], b"1 / 0", lambda x: True) == b"1 / 0"
 
 
+@pytest.mark.parametrize(
+    "expression, result",
+    [(b"10 - 3", b"7"), (b"6 * 7", b"42"), (b"10 / 4", b"2.5"), (b"01 + 1", b"2")],
+)
+def test_can_combine_each_operator(expression: bytes, result: bytes) -> None:
+    assert reduce_with([combine_expressions], expression, lambda x: True) == result
+
+
+def test_does_not_combine_non_operators() -> None:
+    assert reduce_with([combine_expressions], b"1 . 2", lambda x: True) == b"1 . 2"
+
+
 def test_can_combine_expressions_with_no_expressions() -> None:
     assert (
         reduce_with([combine_expressions], b"hello world", lambda x: True)
         == b"hello world"
     )
+
+
+async def test_reduce_integer_makes_logarithmically_many_calls() -> None:
+    calls: list[int] = []
+
+    async def is_interesting(n: int) -> bool:
+        await trio.lowlevel.checkpoint()
+        calls.append(n)
+        return n >= 73
+
+    initial = 10**6
+    problem: BasicReductionProblem[int] = BasicReductionProblem(
+        initial, is_interesting, work=WorkContext(), sort_key=lambda n: n
+    )
+    await reduce_integer(problem)
+
+    assert problem.current_test_case == 73
+    assert len(calls) <= 2 * (73).bit_length() + 1
+
+
+async def test_reduce_integer_finds_small_values_quickly() -> None:
+    calls: list[int] = []
+
+    async def is_interesting(n: int) -> bool:
+        await trio.lowlevel.checkpoint()
+        calls.append(n)
+        return n >= 3
+
+    problem: BasicReductionProblem[int] = BasicReductionProblem(
+        2**64, is_interesting, work=WorkContext(), sort_key=lambda n: n
+    )
+    await reduce_integer(problem)
+
+    assert problem.current_test_case == 3
+    assert calls == [0, 1, 2, 4, 3]
+
+
+@pytest.mark.parametrize("parallelism", [1, 2, 4])
+def test_can_reduce_many_integers(parallelism: int) -> None:
+    def is_interesting(x: bytes) -> bool:
+        values = list(map(int, x.split()))
+        return len(values) == 3 and values[1] >= 17 and values[2] >= 1000
+
+    assert (
+        reduce_with(
+            [reduce_integer_literals],
+            b"12345 99999 123456",
+            is_interesting,
+            parallelism=parallelism,
+        )
+        == b"0 17 1000"
+    )
+
+
+def test_identifier_occurrences_are_whole_words() -> None:
+    assert identifier_occurrences(b"12abc 12 x12 x.y x 3z") == {
+        b"12": [(6, 8)],
+        b"3": [],
+        b"x12": [(9, 12)],
+        b"x": [(13, 14), (17, 18)],
+        b"y": [(15, 16)],
+    }
+
+
+def test_fused_pass_reduces_each_kind_of_region() -> None:
+    assert (
+        reduce_with(
+            [reduce_integers_and_falsey],
+            b"f(100, False, [])",
+            lambda x: x.startswith(b"f("),
+        )
+        == b"f(0, 0, 0)"
+    )
+
+
+def test_fused_pass_can_combine_and_merge() -> None:
+    assert (
+        reduce_with(
+            [combine_expressions_and_strings],
+            b"x = 1 + 2; y = 'a' 'b'",
+            lambda x: True,
+        )
+        == b"x = 3; y = 'ab'"
+    )
+
+
+async def test_fused_pass_hands_regions_to_each_pass() -> None:
+    seen: list[tuple[str, str]] = []
+
+    @regex_pass("[0-9]+")
+    async def numbers(problem: ReductionProblem[str]) -> None:
+        seen.append(("numbers", problem.current_test_case))
+
+    @regex_pass("(?P<letter>[a-z])(?P=letter)", re.IGNORECASE)
+    async def doubled_letters(problem: ReductionProblem[str]) -> None:
+        seen.append(("doubled_letters", problem.current_test_case))
+
+    fused = fused_regex_pass(numbers, doubled_letters)
+    assert fused.__name__ == "numbers+doubled_letters"
+
+    async def is_interesting(test_case: str) -> bool:
+        return True
+
+    await fused(
+        BasicReductionProblem("12 aA 3 bc 45 DD", is_interesting, work=WorkContext())
+    )
+
+    assert sorted(seen) == [
+        ("doubled_letters", "DD"),
+        ("doubled_letters", "aA"),
+        ("numbers", "12"),
+        ("numbers", "3"),
+        ("numbers", "45"),
+    ]
+
+
+def test_can_simplify_brackets() -> None:
+    assert (
+        reduce_with([simplify_brackets], b"f{x[1]}", lambda x: len(x) == 7)
+        == b"f(x(1))"
+    )
+
+
+@pytest.mark.parametrize("parallelism", [1, 2, 4])
+def test_normalize_identifiers_in_parallel(parallelism: int) -> None:
+    def is_interesting(test_case: bytes) -> bool:
+        output: list[int] = []
+        data = {"output": output}
+        try:
+            exec(test_case, data, data)
+        except BaseException:
+            return False
+        return output == [4]
+
+    assert (
+        reduce_with(
+            [normalize_identifiers],
+            b"alpha = 1\nbeta = alpha + 1\ngamma = beta * 2\noutput.append(gamma)",
+            is_interesting,
+            parallelism=parallelism,
+        )
+        == b"A = 1\nA = A + 1\nA = A * 2\noutput.append(A)"
+    )
+
+
+@pytest.mark.parametrize("value", [b"hello", "hello"])
+def test_substring_round_trips(value: bytes | str) -> None:
+    format = Substring(value[:1], value[-1:])
+    assert format.parse(value) == value[1:-1]
+    assert format.dumps(format.parse(value)) == value
+
+
+@pytest.mark.parametrize(
+    "target, replacement, result",
+    [(b"hello world", b"there", b"hello there"), ("hello world", "you", "hello you")],
+)
+def test_splice(
+    target: bytes | str, replacement: bytes | str, result: bytes | str
+) -> None:
+    assert splice(target, 6, 11, replacement) == result
+
+
+@pytest.mark.parametrize("parallelism", [2, 4])
+async def test_concurrent_identifier_replacements_are_not_lost(
+    parallelism: int,
+) -> None:
+    async def is_interesting(test_case: bytes) -> bool:
+        await trio.lowlevel.checkpoint()
+        return True
+
+    # Whether replacements race depends on how trio schedules the targets'
+    # tasks, so we run the pass a number of times to make sure we see it.
+    for _ in range(20):
+        problem: BasicReductionProblem[bytes] = BasicReductionProblem(
+            b"bbbb " + b" ".join([b"cc"] * 6),
+            is_interesting,
+            work=WorkContext(parallelism=parallelism),
+        )
+        await normalize_identifiers(problem)
+
+        assert problem.current_test_case == b" ".join([b"A"] * 7)
+
+
+async def test_parallel_identifier_replacements_match_sequential() -> None:
+    # Random delays mean attempts finish in an arbitrary order, which shouldn't
+    # change which replacement each target ends up with. Only some orders ever
+    # went wrong, so we try a good number of them.
+    for seed in range(100):
+        random = Random(seed)
+
+        async def is_interesting(test_case: bytes) -> bool:
+            for _ in range(random.randrange(10)):
+                await trio.lowlevel.checkpoint()
+            return b"A" not in test_case
+
+        problem: BasicReductionProblem[bytes] = BasicReductionProblem(
+            b"dbhh fcd fcd", is_interesting, work=WorkContext(parallelism=4)
+        )
+        await normalize_identifiers(problem)
+
+        assert problem.current_test_case == b"a a a"
+
+
+async def test_normalize_identifiers_tries_longest_targets_first() -> None:
+    async def is_interesting(test_case: bytes) -> bool:
+        await trio.lowlevel.checkpoint()
+        return True
+
+    for _ in range(20):
+        problem: BasicReductionProblem[bytes] = BasicReductionProblem(
+            b"bbbb cc dd e", is_interesting, work=WorkContext(parallelism=1)
+        )
+        reductions: list[bytes] = []
+
+        async def on_reduce(test_case: bytes) -> None:
+            reductions.append(test_case)
+
+        problem.on_reduce(on_reduce)
+        await normalize_identifiers(problem)
+
+        assert reductions[0] == b"A cc dd e"
+
+
+@pytest.mark.parametrize("parallelism", [2, 4])
+def test_can_merge_regions_reduced_at_the_same_time(parallelism: int) -> None:
+    # Every region fails on the same probes and then succeeds on the same
+    # probe, so regions keep finding that another one has changed the test
+    # case under them. They have to merge their reductions, and the others
+    # have to wait until that's done before they can carry on.
+    def is_interesting(x: bytes) -> bool:
+        values = list(map(int, x.split()))
+        return len(values) == 4 and all(v >= 5 for v in values)
+
+    assert (
+        reduce_with(
+            [reduce_integer_literals],
+            b"100 200 300 400",
+            is_interesting,
+            parallelism=parallelism,
+        )
+        == b"5 5 5 5"
+    )